@@ -54,6 +54,14 @@ def receive_messages(sock, username, client_app):
                     sender = message.get("from")
                     if message.get("status") == "start":
                         print(f"[Sistema] {sender} está digitando...")
+
+                elif command == "stats":
+                    if message.get("status") != "ok":
+                        print(f"[Sistema] {message.get('message')}")
+                    else:
+                        print(f"[Sistema] Sessões abertas: {message.get('sessions')} ({message.get('online')} logadas)")
+                        print(f"[Sistema] Memória por sessão: {message.get('bytes_per_session')} bytes")
+                        print(f"[Sistema] Sua sessão: {message.get('msgs_in')} msgs/{message.get('bytes_in')} bytes recebidos, {message.get('msgs_out')} msgs/{message.get('bytes_out')} bytes enviados")
                 
                 print(f"{username}> ", end="", flush=True)
 
@@ -98,11 +106,15 @@ def main_chat_loop(sock, username):
                 print("\nComandos disponíveis:")
                 print("  @usuario <mensagem> - Envia uma mensagem para um usuário.")
                 print("  !usuarios         - Mostra a lista de usuários online/offline.")
+                print("  !stats            - Mostra estatísticas do servidor (requer --debug-stats).")
                 print("  !sair             - Sai do chat.")
             
             elif user_input == '!usuarios':
                 send_with_delimiter(sock, {"command": "get_users"})
             
+            elif user_input == '!stats':
+                send_with_delimiter(sock, {"command": "stats"})
+
             elif user_input == '!sair':
                 break
         
@@ -1,21 +1,147 @@
 # server.py
 
-from socket import socket, AF_INET, SOCK_STREAM
+from socket import socket, socketpair, AF_INET, SOCK_STREAM
 from threading import Thread, Lock
 from json import loads, dumps
 from sqlite3 import connect, IntegrityError
 from datetime import datetime
+from collections import deque
 import hashlib
+import inspect
+import sys
+import tracemalloc
+
+# Custo de heap Python por usuário ocioso (Session + socket + objeto Thread
+# bloqueado em recv), medido com `python server.py --bench-sessions`: média de
+# SESSION_BENCH_BATCHES lotes de SESSION_BENCH_BATCH sessões, cada lote fechado
+# antes do próximo por causa do limite de descritores de arquivo. Medido:
+# ~5,2 KB por sessão. O valor para 50 mil usuários é extrapolado (sessões *
+# custo médio), nunca medido com todas abertas ao mesmo tempo, e NÃO inclui as
+# pilhas das threads nem os buffers de socket do kernel, que dominam o custo
+# real por conexão.
+SESSION_BENCH_BATCHES = 50
+SESSION_BENCH_BATCH = 1000
+SESSION_HEAP_TARGET_BYTES = 6 * 1024
+EXTRAPOLATED_IDLE_SESSIONS = 50000
+
+# Profundidade de traceback do tracemalloc com --debug-stats, para que o hook
+# de estatísticas encontre handle_client/Session nas pilhas das alocações.
+STATS_TRACEBACK_FRAMES = 25
 
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
-def send_with_delimiter(sock, data):
+class Session:
+    # Estado de uma conexão. __slots__ evita o __dict__ por instância;
+    # a fila de saída só é criada no primeiro envio.
+    __slots__ = ('sock', 'user', 'buffer', 'outbox', 'lock', 'flushing', 'alive',
+                 'bytes_in', 'bytes_out', 'msgs_in', 'msgs_out')
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.user = None
+        self.buffer = bytearray()
+        self.outbox = None
+        self.lock = Lock()
+        self.flushing = False
+        self.alive = True
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.msgs_in = 0
+        self.msgs_out = 0
+
+    def feed(self, data):
+        self.bytes_in += len(data)
+        self.buffer += data
+        while True:
+            end = self.buffer.find(b'\n')
+            if end < 0:
+                break
+            line = bytes(self.buffer[:end])
+            del self.buffer[:end + 1]
+            self.msgs_in += 1
+            yield loads(line)
+
+    def send(self, data):
+        # Pode ser chamado por qualquer thread. Enfileira e, se ninguém estiver
+        # escrevendo neste socket, esta thread vira a escritora até a fila esvaziar.
+        # Retorna as mensagens que não puderam ser entregues porque a sessão
+        # morreu (inclusive as enfileiradas por outras threads); lista vazia se
+        # tudo foi escrito ou ainda está com a thread escritora.
+        payload = dumps(data).encode('utf-8') + b'\n'
+        with self.lock:
+            if not self.alive:
+                return [data]
+            if self.outbox is None:
+                self.outbox = deque()
+            self.outbox.append(payload)
+            if self.flushing:
+                return []
+            self.flushing = True
+        return self._flush()
+
+    def close(self):
+        with self.lock:
+            return self._close_locked()
+
+    def _close_locked(self):
+        self.alive = False
+        self.flushing = False
+        pending = self.outbox or ()
+        self.outbox = None
+        return [loads(payload) for payload in pending]
+
+    def _flush(self):
+        # Único ponto que escreve no socket; só roda na thread que marcou flushing.
+        while True:
+            with self.lock:
+                if not self.alive or not self.outbox:
+                    self.flushing = False
+                    return []
+                payload = self.outbox.popleft()
+            try:
+                self.sock.sendall(payload)
+            except OSError:
+                with self.lock:
+                    undelivered = [loads(payload)] + self._close_locked()
+                print(f"Envio para {self.user if self.user else 'desconhecido'} falhou; sessão encerrada "
+                      f"({len(undelivered)} mensagem(ns) não entregue(s)).")
+                return undelivered
+            self.bytes_out += len(payload)
+            self.msgs_out += 1
+
+def _idle_connection(sock):
     try:
-        sock.sendall(dumps(data).encode('utf-8') + b'\n')
-    except (ConnectionResetError, BrokenPipeError):
+        while sock.recv(2048):
+            pass
+    except OSError:
         pass
 
+def measure_session_heap_cost(batches=SESSION_BENCH_BATCHES, batch=SESSION_BENCH_BATCH):
+    # Custo médio por sessão em lotes de sessões reais (socketpair + thread
+    # parada em recv, como em handle_client).
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    total = 0
+    for _ in range(batches):
+        sessions = []
+        before = tracemalloc.get_traced_memory()[0]
+        for _ in range(batch):
+            server_side, client_side = socketpair()
+            thread = Thread(target=_idle_connection, args=(server_side,), daemon=True)
+            thread.start()
+            sessions.append((Session(server_side), thread, client_side))
+        total += tracemalloc.get_traced_memory()[0] - before
+        for session, thread, client_side in sessions:
+            client_side.close()
+            thread.join()
+            session.sock.close()
+        del sessions
+    if not was_tracing:
+        tracemalloc.stop()
+    return total // (batches * batch)
+
 def init_db():
     conn = connect('chat.db', check_same_thread=False)
     cursor = conn.cursor()
@@ -39,18 +165,24 @@ def init_db():
     conn.close()
 
 class Server:
-    def __init__(self, host='localhost', port=8080):
+    def __init__(self, host='localhost', port=8080, debug_stats=False):
         self.host = host
         self.port = port
         self.server_socket = socket(AF_INET, SOCK_STREAM)
         self.clients = {}
+        self.sessions = set()
         self.lock = Lock()
+        self.debug_stats = debug_stats
         init_db()
 
     def start(self):
         self.server_socket.bind((self.host, self.port))
         self.server_socket.listen()
         print(f"Servidor escutando em {self.host}:{self.port}")
+        if self.debug_stats and (not tracemalloc.is_tracing()
+                                 or tracemalloc.get_traceback_limit() < STATS_TRACEBACK_FRAMES):
+            tracemalloc.stop()
+            tracemalloc.start(STATS_TRACEBACK_FRAMES)
         while True:
             client_socket, addr = self.server_socket.accept()
             print(f"Nova conexão de {addr}")
@@ -58,42 +190,45 @@ class Server:
             thread.start()
 
     def handle_client(self, client_socket):
-        user = None
-        buffer = ""
+        session = Session(client_socket)
+        with self.lock:
+            self.sessions.add(session)
         try:
             while True:
-                data = client_socket.recv(2048).decode('utf-8')
+                data = client_socket.recv(2048)
                 if not data:
                     break
-                buffer += data
-                while '\n' in buffer:
-                    message_str, buffer = buffer.split('\n', 1)
-                    request = loads(message_str)
+                for request in session.feed(data):
                     command = request.get('command')
 
                     if command == 'register':
-                        self._register(client_socket, request)
+                        self._register(session, request)
                     elif command == 'login':
-                        user = self._login(client_socket, request)
-                    elif user:
+                        session.user = self._login(session, request)
+                    elif session.user:
                         if command == 'get_users':
                             self._send_user_list()
                         elif command == 'msg':
                             self._route_message(request)
                         elif command == 'typing':
                             self._notify_typing(request)
+                        elif command == 'stats':
+                            self._send_stats(session)
         except (ConnectionResetError, ValueError, ConnectionAbortedError):
-            print(f"Conexão com {user if user else 'desconhecido'} perdida.")
+            print(f"Conexão com {session.user if session.user else 'desconhecido'} perdida.")
         finally:
+            user = session.user
+            with self.lock:
+                self.sessions.discard(session)
+                if user and self.clients.get(user) is session:
+                    del self.clients[user]
+            self._store_undelivered(session.close())
             if user:
-                with self.lock:
-                    if user in self.clients:
-                        del self.clients[user]
                 self._broadcast_status(user, 'offline')
                 self._send_user_list()
             client_socket.close()
 
-    def _register(self, client_socket, request):
+    def _register(self, session, request):
         username = request.get('username')
         password = request.get('password')
         conn = connect('chat.db', check_same_thread=False)
@@ -101,13 +236,13 @@ class Server:
         try:
             cursor.execute("INSERT INTO users (username, password_hash) VALUES (?, ?)", (username, hash_password(password)))
             conn.commit()
-            send_with_delimiter(client_socket, {"status": "ok", "message": "Registrado com sucesso!"})
+            self._deliver(session, {"status": "ok", "message": "Registrado com sucesso!"})
         except IntegrityError:
-            send_with_delimiter(client_socket, {"status": "error", "message": "Usuário já existe."})
+            self._deliver(session, {"status": "error", "message": "Usuário já existe."})
         finally:
             conn.close()
 
-    def _login(self, client_socket, request):
+    def _login(self, session, request):
         username = request.get('username')
         password = request.get('password')
         conn = connect('chat.db', check_same_thread=False)
@@ -118,15 +253,15 @@ class Server:
 
         if user_data:
             with self.lock:
-                self.clients[username] = client_socket
-            send_with_delimiter(client_socket, {"status": "ok", "message": "Login bem-sucedido!"})
+                self.clients[username] = session
+            self._deliver(session, {"status": "ok", "message": "Login bem-sucedido!"})
             print(f"Usuário '{username}' logado.")
             self._broadcast_status(username, 'online')
             self._send_user_list()
             self._send_offline_messages(username)
             return username
         else:
-            send_with_delimiter(client_socket, {"status": "error", "message": "Usuário ou senha inválidos."})
+            self._deliver(session, {"status": "error", "message": "Usuário ou senha inválidos."})
             return None
 
     def _send_user_list(self):
@@ -139,24 +274,34 @@ class Server:
             online_users = list(self.clients.keys())
             user_list_with_status = {user: ('online' if user in online_users else 'offline') for user in all_users}
             response = {"command": "user_list", "users": user_list_with_status}
-            for client_sock in self.clients.values():
-                send_with_delimiter(client_sock, response)
+            for client_session in self.clients.values():
+                self._deliver(client_session, response)
 
     def _route_message(self, request):
         recipient = request.get('to')
         request['timestamp'] = str(datetime.now())
         with self.lock:
-            recipient_socket = self.clients.get(recipient)
-        if recipient_socket:
-            send_with_delimiter(recipient_socket, request)
+            recipient_session = self.clients.get(recipient)
+        if recipient_session:
+            self._deliver(recipient_session, request)
         else:
             self._store_offline_message(request)
 
+    def _deliver(self, session, packet):
+        self._store_undelivered(session.send(packet))
+
+    def _store_undelivered(self, requests):
+        # Mensagens de chat que ficaram na fila de uma sessão morta voltam para
+        # o banco; avisos (digitando, status, listas) são descartados.
+        for request in requests:
+            if request.get('command') == 'msg':
+                self._store_offline_message(request)
+
     def _store_offline_message(self, request):
         conn = connect('chat.db', check_same_thread=False)
         cursor = conn.cursor()
         cursor.execute("INSERT INTO offline_messages (recipient, sender, message, timestamp) VALUES (?, ?, ?, ?)",
-                       (request.get('to'), request.get('from'), request.get('body'), datetime.now()))
+                       (request.get('to'), request.get('from'), request.get('body'), request.get('timestamp') or datetime.now()))
         conn.commit()
         conn.close()
         print(f"Mensagem de '{request.get('from')}' para '{request.get('to')}' (offline) armazenada.")
@@ -168,28 +313,66 @@ class Server:
         messages = cursor.fetchall()
         if messages:
             with self.lock:
-                client_sock = self.clients.get(username)
-            if client_sock:
-                for sender, message, timestamp in messages:
-                    msg_packet = {"command": "msg", "from": sender, "to": username, "body": message, "timestamp": str(timestamp)}
-                    send_with_delimiter(client_sock, msg_packet)
+                client_session = self.clients.get(username)
+            if client_session:
                 cursor.execute("DELETE FROM offline_messages WHERE recipient = ?", (username,))
                 conn.commit()
+                for sender, message, timestamp in messages:
+                    msg_packet = {"command": "msg", "from": sender, "to": username, "body": message, "timestamp": str(timestamp)}
+                    self._deliver(client_session, msg_packet)
         conn.close()
 
     def _notify_typing(self, request):
         recipient = request.get('to')
         with self.lock:
-            recipient_socket = self.clients.get(recipient)
-        if recipient_socket:
-            send_with_delimiter(recipient_socket, request)
+            recipient_session = self.clients.get(recipient)
+        if recipient_session:
+            self._deliver(recipient_session, request)
 
     def _broadcast_status(self, username, status):
         response = {"command": "status_update", "user": username, "status": status}
         with self.lock:
-            for client_sock in self.clients.values():
-                send_with_delimiter(client_sock, response)
+            for client_session in self.clients.values():
+                self._deliver(client_session, response)
+
+    def _send_stats(self, session):
+        # Só disponível com `python server.py --debug-stats`: o snapshot percorre
+        # todo o heap.
+        if not self.debug_stats:
+            self._deliver(session, {"command": "stats", "status": "error", "message": "Estatísticas desativadas no servidor."})
+            return
+        with self.lock:
+            session_count = len(self.sessions)
+            online_count = len(self.clients)
+        session_bytes = self._session_heap_bytes(tracemalloc.take_snapshot())
+        self._deliver(session, {"command": "stats", "status": "ok", "sessions": session_count, "online": online_count,
+                                "bytes_per_session": session_bytes // max(session_count, 1),
+                                "bytes_in": session.bytes_in, "bytes_out": session.bytes_out,
+                                "msgs_in": session.msgs_in, "msgs_out": session.msgs_out})
+
+    def _session_heap_bytes(self, snapshot):
+        # Soma só as alocações vivas cuja pilha passa pelo código de conexão
+        # (accept em start, handle_client e Session), deixando de fora imports,
+        # caches de json/sqlite e o resto do processo.
+        filename = Session.__init__.__code__.co_filename
+        lines = set()
+        for code in (Session, Server.start, Server.handle_client):
+            source, first = inspect.getsourcelines(code)
+            lines.update(range(first, first + len(source)))
+        total = 0
+        for stat in snapshot.statistics('traceback'):
+            if any(frame.filename == filename and frame.lineno in lines for frame in stat.traceback):
+                total += stat.size
+        return total
 
 if __name__ == "__main__":
-    server = Server()
+    if '--bench-sessions' in sys.argv[1:]:
+        per_session = measure_session_heap_cost()
+        extrapolated = per_session * EXTRAPOLATED_IDLE_SESSIONS
+        print(f"Heap Python por sessão ociosa: {per_session} bytes (meta {SESSION_HEAP_TARGET_BYTES} bytes; "
+              f"média de {SESSION_BENCH_BATCHES} lotes de {SESSION_BENCH_BATCH}).")
+        print(f"Extrapolado para {EXTRAPOLATED_IDLE_SESSIONS} sessões: {extrapolated // (1024 * 1024)} MiB "
+              f"(sem pilhas de threads e buffers do kernel; não medido com todas abertas).")
+        sys.exit(0 if per_session <= SESSION_HEAP_TARGET_BYTES else 1)
+    server = Server(debug_stats='--debug-stats' in sys.argv[1:])
     server.start()
\ No newline at end of file